@@ -1,21 +1,51 @@
 from __future__ import print_function, unicode_literals, division
 
 import argparse
+import calendar
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from itertools import islice
 import io
 import json
 import os
+import pickle
+import pwd
 import re
 import shutil
 import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-import xml.etree.ElementTree as ET
 
+try:
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
+    # the stdlib parser is slower, but works the same here
+    import xml.etree.ElementTree as ET
+    HAVE_LXML = False
 
-escape_illegal_xml_characters = lambda x: re.sub(u'[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]', '', x)
+
+ILLEGAL_XML_CHARACTERS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
+escape_illegal_xml_characters = lambda x: ILLEGAL_XML_CHARACTERS.sub('', x)
+
+
+class ScrubbedReader(object):
+    """Read a text file as utf-8 bytes, dropping illegal xml characters"""
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        while True:
+            data = self.f.read(size)
+            scrubbed = escape_illegal_xml_characters(data)
+            # an empty result means EOF, so skip chunks that scrub to nothing
+            if scrubbed or not data:
+                return scrubbed.encode('utf-8')
 
 
 CHMOD_OWNER_FILE = stat.S_IRUSR | stat.S_IWUSR
@@ -24,9 +54,13 @@ CHMOD_ALL_FILE = CHMOD_OWNER_FILE | stat.S_IRGRP | stat.S_IROTH
 CHMOD_ALL_DIR = CHMOD_OWNER_FILE | stat.S_IRGRP | stat.S_IROTH | stat.S_IXGRP | stat.S_IXOTH
 
 
+SANITIZE_TABLE = dict((ord(c), '-') for c in '/;$')
+
+
+@lru_cache(maxsize=None)
 def sanitize(name):
     # convert name to valid posix
-    return name.replace('/', '-').replace(';', '-').replace('$', '-')
+    return name.translate(SANITIZE_TABLE)
 
 
 # load username to uid cache
@@ -35,16 +69,34 @@ UID_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'username_uid_map.json'
 if os.path.exists(UID_CACHE_PATH):
     with open(UID_CACHE_PATH) as f:
         UID_CACHE.update(json.load(f))
-else:
-    print('Loading usernames from LDAP', file=sys.stderr, end='\n')
-    from ldap3 import Connection, ALL
-    conn = Connection('ldap-1.icecube.wisc.edu', auto_bind=True)
-    entries = conn.extend.standard.paged_search('ou=People,dc=icecube,dc=wisc,dc=edu', '(objectclass=posixAccount)', attributes=['uid', 'uidNumber'], paged_size=100)
-    for entry in entries:
-        attrs = entry['attributes']
-        UID_CACHE[attrs['uid'][0]] = attrs['uidNumber']
-    with open(UID_CACHE_PATH, 'w') as f:
-        json.dump(UID_CACHE, f)
+# local accounts win, and with nss resolving LDAP (sssd) this has the LDAP users too
+PASSWD_UIDS = dict((p.pw_name, p.pw_uid) for p in pwd.getpwall())
+UID_CACHE.update(PASSWD_UIDS)
+
+
+def load_ldap_uids(usernames):
+    """Search LDAP for uids, only if some of the usernames are still unknown"""
+    missing = set(usernames).difference(UID_CACHE)
+    if missing and not os.path.exists(UID_CACHE_PATH):
+        print('Loading usernames from LDAP', file=sys.stderr, end='\n')
+        from ldap3 import Connection
+        conn = Connection('ldap-1.icecube.wisc.edu', auto_bind=True)
+        entries = conn.extend.standard.paged_search('ou=People,dc=icecube,dc=wisc,dc=edu', '(objectclass=posixAccount)', attributes=['uid', 'uidNumber'], paged_size=100)
+        ldap_uids = {}
+        for entry in entries:
+            attrs = entry['attributes']
+            ldap_uids[attrs['uid'][0]] = attrs['uidNumber']
+        # write the complete map aside first, so a failed run never leaves a partial cache
+        with open(UID_CACHE_PATH+'.tmp', 'w') as f:
+            json.dump(ldap_uids, f)
+        os.replace(UID_CACHE_PATH+'.tmp', UID_CACHE_PATH)
+        # same precedence as a later run loading the cache: defaults, LDAP, passwd
+        UID_CACHE.update(ldap_uids)
+        UID_CACHE.update(PASSWD_UIDS)
+        missing.difference_update(UID_CACHE)
+    if missing:
+        # the cache holds a full LDAP search, so these users are gone from LDAP too
+        print('No uid for', len(missing), 'users, their files will be owned by root:', ' '.join(sorted(missing)), file=sys.stderr)
 
 
 def total_seconds(timedelta):
@@ -52,18 +104,133 @@ def total_seconds(timedelta):
     return int(timedelta.seconds + timedelta.days * 24 * 3600)
 
 
+MONTHS = dict((m, i) for i, m in enumerate(calendar.month_abbr) if m)
+# dates are naive, and measured against the local epoch
+EPOCH_OFFSET = total_seconds(datetime.fromtimestamp(0) - datetime(1970, 1, 1))
+
+
+def parse_date(s):
+    """Parse a Docushare date, like 'Wed Jun 05 12:34:56 UTC 2024', to seconds"""
+    try:
+        return calendar.timegm((int(s[-4:]), MONTHS[s[4:7]], int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]), 0, 0, 0)) - EPOCH_OFFSET
+    except (KeyError, ValueError):
+        # not in the fixed layout, so let strptime sort it out
+        return total_seconds(datetime.strptime(s, '%a %b %d %H:%M:%S %Z %Y') - datetime.fromtimestamp(0))
+
+
 IGNORE_DOC_TYPES = ('Group', 'BulletinBoard', 'Bulletin', 'Weblog', 'WeblogEntry', 'Event', 'Calendar', 'Wiki', 'WikiPage')
 
+# records that only carry a type are shared, so they must never be modified
+TYPE_ONLY_DOCS = dict((t, {'type': t}) for t in ('Document', 'URL') + IGNORE_DOC_TYPES)
+
+
+# groups that make an object public when granted readobject
+PUBLIC_PRINCIPALS = ('Group-4', 'Group-5', 'Group-7')
+
+def xpath(path):
+    """Compile an XPath union of simple paths, optionally ending in text()"""
+    if HAVE_LXML:
+        # compiled once, evaluated by libxml2
+        return ET.XPath(path, smart_strings=False)
+
+    paths = path.split(' | ')
+    def find(elem):
+        ret = []
+        for p in paths:
+            if p.endswith('/text()'):
+                ret.extend(e.text for e in elem.iterfind(p[:-len('/text()')]) if e.text)
+            else:
+                ret.extend(elem.findall(p))
+        return ret
+    return find
+
+
+XPATH_PUBLIC_ACLS = xpath(' | '.join("acls/*[@principal='%s']" % p for p in PUBLIC_PRINCIPALS))
+XPATH_PROPS = xpath('props/*')
+XPATH_VERSIONS = xpath('versions/dsobject')
+XPATH_OWNER = xpath('destinationlinks/owner/text()')
+XPATH_PREFERRED_VERSION = xpath('destinationlinks/preferredVersion/text()')
+XPATH_RENDITIONS = xpath('renditions/dsobject')
+XPATH_CONTENT_ELEMENTS = xpath('contentelements/contentelement')
+XPATH_CONTAINMENT = xpath('destinationlinks/containment/text()')
+
+
+def get_props(elem):
+    """Map the names of an element's Docushare props to their text"""
+    return dict((prop.attrib['name'], prop.text) for prop in XPATH_PROPS(elem))
+
+
+def iter_children(source, **kwargs):
+    """Stream the direct children of the XML root, freeing each after use"""
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(source, events=('start', 'end'), **kwargs):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        yield elem
+        elem.clear()
+        if HAVE_LXML:
+            # fast-iter: drop the element and any already processed siblings
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        else:
+            root.remove(elem)
+
+
+def get_documents_from_path(path, details=False):
+    """Parse a Docushare XML export, streaming it from disk"""
+    kwargs = {'huge_tree': True} if HAVE_LXML else {}
+    with io.open(path, 'r', encoding='utf-8') as f:
+        # only the illegal characters are dropped, so a truncated export still fails
+        return parse_documents(iter_children(ScrubbedReader(f), **kwargs), details)
+
+
+def get_documents_cached(path):
+    """Parse a dsexport metadata export, reusing a pickle of an earlier parse"""
+    cache_path = path+'.pickle'
+    try:
+        # stale if either the export or this script changed since
+        if os.path.getmtime(cache_path) >= max(os.path.getmtime(path), os.path.getmtime(__file__)):
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+    except OSError:
+        pass
+
+    # a damaged export raises here, so only complete parses are cached
+    documents = get_documents_from_path(path)
+    try:
+        with open(cache_path+'.tmp', 'wb') as f:
+            pickle.dump(documents, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_path+'.tmp', cache_path)
+    except OSError:
+        # the cache is only a shortcut for later runs
+        print('cannot write cache', cache_path, file=sys.stderr)
+    return documents
+
+
+class ParseError(Exception):
+    """A dsobject that cannot be converted, reported along with its XML"""
+    def __init__(self, msg, xml):
+        # keep the XML as text, so the error can come back from a worker process
+        super(ParseError, self).__init__(msg, xml)
 
-def get_documents(data, details=False):
-    """Parse Docushare XML"""
-    root = ET.fromstring(data.encode('utf-8'))
+    def __str__(self):
+        return '\n'.join(self.args)
 
+
+def parse_documents(children, details=False):
+    """Parse Docushare dsobjects"""
     collections = {}
     documents = {}
     users = {}
 
-    for child in root:
+    for child in children:
         if 'classname' not in child.attrib:
             continue
 
@@ -71,80 +238,56 @@ def get_documents(data, details=False):
         type_ = child.attrib['classname']
 
         if type_ in ('Document', 'Collection', 'URL'):
-            owner = None
-            for obj in child.findall('./destinationlinks/owner'):
-                owner = obj.text
+            owners = XPATH_OWNER(child)
+            # a few users own everything, so share one string per owner
+            owner = sys.intern(owners[0]) if owners else None
 
             private = True
-            acls = child.find('acls')
-            for acl in acls:
-                if acl.attrib['principal'] == 'Group-4':
-                    if 'readobject' in acl.attrib['permissions']:
-                        private = False
-                        break
-                if acl.attrib['principal'] == 'Group-5':
-                    if 'readobject' in acl.attrib['permissions']:
-                        private = False
-                        break
-                if acl.attrib['principal'] == 'Group-7':
-                    if 'readobject' in acl.attrib['permissions']:
-                        private = False
-                        break
+            for acl in XPATH_PUBLIC_ACLS(child):
+                if 'readobject' in acl.attrib['permissions']:
+                    private = False
+                    break
             
         if type_ == 'Document':
             if not details:
-                documents[id_] = {
-                    'type': 'Document',
-                }
+                documents[id_] = TYPE_ONLY_DOCS['Document']
             else:
-                props = child.find('props')
+                props = get_props(child)
                 title = id_
                 original_file_name = None
-                if props is not None and len(props) > 0:
-                    for prop in props:
-                        if prop.attrib['name'] == 'title':
-                            title = prop.text.strip()
-                        if prop.attrib['name'] == 'original_file_name':
-                            original_file_name = prop.text.strip()
-
-                versions = child.find('versions')
-                if versions is None:
-                    print(ET.tostring(child).decode('utf8'))
-                    raise Exception('no versions')
+                if 'title' in props:
+                    title = props['title'].strip()
+                if 'original_file_name' in props:
+                    original_file_name = props['original_file_name'].strip()
+
+                versions = XPATH_VERSIONS(child)
+                if not versions:
+                    raise ParseError('no versions', ET.tostring(child, encoding='unicode'))
                 elif len(versions) == 1:
-                    version_object = versions.findall('dsobject')[0]
+                    version_object = versions[0]
                 else:
-                    for obj in child.findall('./destinationlinks/preferredVersion'):
-                        # we have a preferred version, so use it
-                        handle = obj.text
-                        #print("preferred version handle", handle)
-                        for v in versions.findall('dsobject'):
-                            if v.attrib['handle'] == handle:
-                                version_object = v
-                                break
-                        else:
-                            raise Exception('no matching version')
-                        break
-                    else:
-                        print(ET.tostring(child))
-                        raise Exception('no preferredVersion')
-
-                renditions = version_object.findall('./renditions/dsobject')
+                    preferred = XPATH_PREFERRED_VERSION(child)
+                    if not preferred:
+                        raise ParseError('no preferredVersion', ET.tostring(child, encoding='unicode'))
+                    # we have a preferred version, so use it
+                    versions_by_handle = dict((v.attrib['handle'], v) for v in versions)
+                    if preferred[0] not in versions_by_handle:
+                        raise Exception('no matching version')
+                    version_object = versions_by_handle[preferred[0]]
+
+                renditions = XPATH_RENDITIONS(version_object)
                 if len(renditions) == 0:
-                    print(ET.tostring(child))
-                    raise Exception('no rendition')
+                    raise ParseError('no rendition', ET.tostring(child, encoding='unicode'))
                 elif len(renditions) > 1:
-                    print(ET.tostring(child))
-                    raise Exception('too many renditions')
+                    raise ParseError('too many renditions', ET.tostring(child, encoding='unicode'))
                 size = -1
                 date = None
                 for r in renditions:
-                    for prop in r.find('props'):
-                        if prop.attrib['name'] == 'size':
-                            size = prop.text
-                        if prop.attrib['name'] == 'create_date':
-                            date = total_seconds(datetime.strptime(prop.text, '%a %b %d %H:%M:%S %Z %Y') - datetime.fromtimestamp(0))
-                    for o in r.findall('./contentelements/contentelement'):
+                    props = get_props(r)
+                    size = props.get('size', -1)
+                    if 'create_date' in props:
+                        date = parse_date(props['create_date'])
+                    for o in XPATH_CONTENT_ELEMENTS(r):
                         filename = o.attrib['filename']
                         if title == id_:
                             title = o.text.strip()
@@ -171,17 +314,16 @@ def get_documents(data, details=False):
             title = ''
             sort_order = 'Title'
             date = None
-            props = child.find('props')
-            if props is None or len(props) == 0:
+            props = get_props(child)
+            if not props:
                 title = id_
             else:
-                for prop in props:
-                    if prop.attrib['name'] == 'title':
-                        title = prop.text.strip()
-                    if prop.attrib['name'] == 'sort_order':
-                        sort_order = prop.text.strip()
-                    if prop.attrib['name'] == 'create_date':
-                        date = total_seconds(datetime.strptime(prop.text, '%a %b %d %H:%M:%S %Z %Y') - datetime.fromtimestamp(0))
+                if 'title' in props:
+                    title = props['title'].strip()
+                if 'sort_order' in props:
+                    sort_order = sys.intern(props['sort_order'].strip())
+                if 'create_date' in props:
+                    date = parse_date(props['create_date'])
 
             documents[id_] = {
                 'type': 'Collection',
@@ -190,26 +332,23 @@ def get_documents(data, details=False):
                 'date': date,
                 'owner': owner,
                 'private': private,
-                'children': [e.text for e in child.findall('./destinationlinks/containment')],
+                'children': XPATH_CONTAINMENT(child),
             }
 
         elif type_ == 'URL':
             if not details:
-                documents[id_] = {
-                    'type': 'URL',
-                }
+                documents[id_] = TYPE_ONLY_DOCS['URL']
             else:
                 title = ''
                 url = ''
-                props = child.find('props')
-                if props is None or len(props) == 0:
+                props = get_props(child)
+                if not props:
                     title = id_
                 else:
-                    for prop in props:
-                        if prop.attrib['name'] == 'title':
-                            title = prop.text.strip()
-                        if prop.attrib['name'] == 'url':
-                            url = prop.text.strip()
+                    if 'title' in props:
+                        title = props['title'].strip()
+                    if 'url' in props:
+                        url = props['url'].strip()
 
                 if not url:
                     continue
@@ -223,17 +362,12 @@ def get_documents(data, details=False):
                 }
 
         elif type_ == 'User':
-            props = child.find('props')
-            if props is None:
-                print(ET.tostring(child))
-                raise Exception('no props')
-            username = None
-            for prop in props:
-                if prop.attrib['name'] == 'username':
-                    username = prop.text.strip()
-                    break
-            else:
+            props = get_props(child)
+            if not props:
+                raise ParseError('no props', ET.tostring(child, encoding='unicode'))
+            if 'username' not in props:
                 raise Exception('no username in user')
+            username = props['username'].strip()
 
             documents[id_] = {
                 'type': 'User',
@@ -241,15 +375,10 @@ def get_documents(data, details=False):
             }
 
         elif type_ in IGNORE_DOC_TYPES:
-            documents[id_] = {
-                'type': type_,
-            }
+            documents[id_] = TYPE_ONLY_DOCS[type_]
 
         else:
-            print(ET.tostring(child).decode('utf8'))
-            raise Exception('new type')
-
-        child.clear()
+            raise ParseError('new type', ET.tostring(child, encoding='unicode'))
 
     return documents
 
@@ -258,6 +387,19 @@ class TreeNode(list):
     def __init__(self):
         super(TreeNode, self).__init__()
         self.parent = None
+        # mirror of the list, for fast membership tests
+        self.members = set()
+
+    def __contains__(self, id_):
+        return id_ in self.members
+
+    def append(self, id_):
+        super(TreeNode, self).append(id_)
+        self.members.add(id_)
+
+    def extend(self, ids):
+        super(TreeNode, self).extend(ids)
+        self.members.update(ids)
 
 
 class Tree:
@@ -301,9 +443,25 @@ class Tree:
             self.roots.discard(child_id)
 
 
+def title_keys(tree, id_):
+    """Title sort keys for the children of a collection, untitled last"""
+    documents = tree.documents
+    keys = {}
+    for k in tree.nodes[id_]:
+        doc = documents.get(k)
+        # metadata-only documents have no title, so avoid raising for them
+        if doc is not None and 'title' in doc:
+            keys[k] = (0, doc['title'])
+        else:
+            keys[k] = (1, '')
+    return keys
+
+
 class TreeSorts:
     @staticmethod
+    @lru_cache(maxsize=None)
     def lookup(name):
+        # few distinct names, and unknown ones would otherwise raise per collection
         try:
             return getattr(TreeSorts, name)
         except AttributeError:
@@ -311,21 +469,11 @@ class TreeSorts:
 
     @staticmethod
     def Title(tree, id_):
-        def key(k):
-            try:
-                return (0, tree.documents[k]['title'])
-            except KeyError:
-                return (1,'')
-        tree.nodes[id_].sort(key=key)
+        tree.nodes[id_].sort(key=title_keys(tree, id_).__getitem__)
 
     @staticmethod
     def TitleReversed(tree, id_):
-        def key(k):
-            try:
-                return (0, tree.documents[k]['title'])
-            except KeyError:
-                return (1,'')
-        tree.nodes[id_].sort(key=key, reverse=True)
+        tree.nodes[id_].sort(key=title_keys(tree, id_).__getitem__, reverse=True)
 
     TypeAndTitle = Title
     TypeAndTitleReversed = TitleReversed
@@ -337,17 +485,17 @@ class TreeSorts:
 
 def build_tree(documents):
     tree = Tree(documents)
-    for id_ in documents:
-        doc = documents[id_]
+    for id_, doc in documents.items():
         if doc['type'] == 'Collection':
             tree.add_node(id_, children=doc['children'])
             for child in doc['children']:
                 if child.startswith('Collection'):
                     tree.set_parent(id_, child)
-    for id_ in documents:
-        doc = documents[id_]
-        if doc['type'] == 'Collection' and doc['children']:
-            TreeSorts.lookup(doc['sort_order'])(tree, id_)
+            # only this collection adds to its own children, so sort now
+            if doc['children']:
+                sort = TreeSorts.lookup(doc['sort_order'])
+                if sort is not TreeSorts.Default:
+                    sort(tree, id_)
     return tree
 
 
@@ -359,44 +507,55 @@ class TreeWalker:
         self.seen = set()
 
     def _traverse_dfs(self, id_, parents):
+        # iterates with a stack of child iterators rather than recursing.
+        # parents are tuples, built once per collection and shared by its children
         level = len(parents)
         if self.skip_level and level >= self.skip_level:
             return
 
         self.seen.add(id_)
         yield id_, parents
-        new_parents = parents + [id_]
-        for d in self.tree.nodes[id_]:
-            if d in self.tree.documents:
-                doc = self.tree.documents[d]
-            else:
-                doc = {'type': 'Document'}
-            if doc['type'] == 'Collection':
-                if d in new_parents or d in self.seen:
-                    # anti-loop code
-                    continue
-                for ret in self._traverse_helper(d, new_parents):
-                    yield ret
+        stack = [(iter(self.tree.nodes[id_]), parents + (id_,))]
+        while stack:
+            children, parents = stack[-1]
+            for d in children:
+                if d in self.tree.documents:
+                    doc = self.tree.documents[d]
+                else:
+                    doc = {'type': 'Document'}
+                if doc['type'] == 'Collection':
+                    if d in parents or d in self.seen:
+                        # anti-loop code
+                        continue
+                    if self.skip_level and len(parents) >= self.skip_level:
+                        continue
+                    self.seen.add(d)
+                    yield d, parents
+                    # descend, resuming this collection once d is done
+                    stack.append((iter(self.tree.nodes[d]), parents + (d,)))
+                    break
+                else:
+                    yield d, parents
             else:
-                yield d, new_parents
+                stack.pop()
 
     def traverse(self, id_=None):
         ids = [id_] if id_ else self.tree.roots
         
         if self.traversal_type == 'dfs':
             for id_ in ids:
-                for ret in self._traverse_dfs(id_, []):
+                for ret in self._traverse_dfs(id_, ()):
                     yield ret
         else: # bfs
             for id_ in ids:
-                yield id_, []
+                yield id_, ()
 
-            queue = [(id_, []) for id_ in ids]
+            # parents are tuples, shared by all children of a collection
+            queue = deque((id_, ()) for id_ in ids)
             while queue:
-                id_, parents = queue[0]
-                queue = queue[1:]
+                id_, parents = queue.popleft()
                 self.seen.add(id_)
-                parents.append(id_)
+                parents += (id_,)
                 for d in self.tree.nodes[id_]:
                     if d in self.tree.documents:
                         doc = self.tree.documents[d]
@@ -406,7 +565,7 @@ class TreeWalker:
                         if d in parents or d in self.seen:
                             # anti-loop code
                             continue
-                        queue.append((d, list(parents)))
+                        queue.append((d, parents))
                     yield d, parents
 
 
@@ -422,18 +581,72 @@ def progress(total, iterator):
 
 DOCUHIDE_PATH = '/root/docuhide/'
 
+# dsexport output, opened on first use and shared by all exports
+export_log = None
+export_log_lock = threading.Lock()
+
 
-def dsexport(arg, recursive=False, metadata=False, props=None):
-    cmd = './dsexport.sh -d '+DOCUHIDE_PATH+' '
+def dsexport(handles, recursive=False, metadata=False, props=None, dest=None):
+    """Export a list of handles in one dsexport run, into dest or DOCUHIDE_PATH"""
+    global export_log
+    cmd = ['./dsexport.sh', '-d', dest or DOCUHIDE_PATH]
     if recursive:
-        cmd += '-r -t 8 '
+        cmd += ['-r', '-t', '8']
     if metadata:
-        cmd += '-m '
+        cmd.append('-m')
     if props:
-        cmd += '-p '+','.join(props)+' '
-    cmd += arg
-    FNULL = open('/root/docuhide/export_err', 'w')
-    subprocess.check_call(cmd, cwd='/root/docushare/bin', shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+        cmd += ['-p', ','.join(props)]
+    cmd.extend(handles)
+    with export_log_lock:
+        if export_log is None:
+            export_log = open(DOCUHIDE_PATH+'export_err', 'w')
+    # no shell, so the handles are passed through as is
+    subprocess.check_call(cmd, cwd='/root/docushare/bin', stdout=export_log, stderr=subprocess.STDOUT)
+
+
+def set_metadata(path, uid, perms, date=None):
+    """Set times, ownership and perms, resolving the path only once"""
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        if date is not None:
+            try:
+                os.utime(fd, (date, date))
+            except Exception:
+                print('cannot set time on', path, file=sys.stderr)
+        os.fchown(fd, uid, uid)
+        os.fchmod(fd, perms)
+    finally:
+        os.close(fd)
+
+
+def copy_document(src_path, dest_path):
+    """Place an exported document in the output tree"""
+    try:
+        # the export is removed right after, so a hard link is as good as a copy
+        os.link(src_path, dest_path)
+        return
+    except FileExistsError:
+        if os.path.samefile(src_path, dest_path):
+            # already linked, by a rerun or a document sharing this file
+            return
+    except OSError:
+        # different filesystem, or one without hard links
+        shutil.copyfile(src_path, dest_path)
+        return
+
+    # left over from a previous run, so swap in a fresh link
+    tmp_path = os.path.join(os.path.dirname(dest_path), '.'+os.path.basename(dest_path)+'.tmp')
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        # no hard link possible here, so simply overwrite the old file
+        shutil.copyfile(src_path, dest_path)
+        return
+    os.replace(tmp_path, dest_path)
 
 
 def main():
@@ -441,48 +654,42 @@ def main():
     parser.add_argument('--input_xml', nargs='+', help='use input xml path for testing')
     parser.add_argument('--output', help='output directory (specify to get output)')
     parser.add_argument('--output-mapping', default='/dev/null', help='output mapping file (id,path)')
-    parser.add_argument('--parallel', default=1, type=int, help='parallel document lookup for output')
+    parser.add_argument('--parallel', default=32, type=int, help='parallel document lookup for output')
+    parser.add_argument('--export-workers', default=2, type=int, help='document batches to export at once')
     parser.add_argument('--max-depth', default=None, type=int, help='max depth of output tree')
     parser.add_argument('--sub-collection', default=None, help='sub-collection to run on')
     args = parser.parse_args()
 
     documents = {}
-    if args.input_xml:
-        for path in args.input_xml:
-            with io.open(path, 'r', encoding='utf-8') as f:
-                input_xml = escape_illegal_xml_characters(f.read())
-                documents.update(get_documents(input_xml, details=True))
-                del input_xml
-    else:
-        path = DOCUHIDE_PATH+'Collection/Collection.xml'
-        if not os.path.exists(path):
-            print('Running dsexport for Collection metadata', file=sys.stderr, end='\n')
-            dsexport('Collection', metadata=True, props=['title', 'create_date', 'sort_order'])
-        print('Processing Collection metadata', file=sys.stderr, end='\n')
-        with io.open(path, 'r', encoding='utf-8') as f:
-            input_xml = escape_illegal_xml_characters(f.read())
-        documents.update(get_documents(input_xml))
-        del input_xml
-
-        path = DOCUHIDE_PATH+'Document/Document.xml'
-        if not os.path.exists(path):
-            print('Running dsexport for Document metadata', file=sys.stderr, end='\n')
-            dsexport('Document', metadata=True, props=['noprops'])
-        print('Processing Document metadata', file=sys.stderr, end='\n')
-        with io.open(path, 'r', encoding='utf-8') as f:
-            input_xml = escape_illegal_xml_characters(f.read())
-        documents.update(get_documents(input_xml))
-        del input_xml
-
-        path = DOCUHIDE_PATH+'URL/URL.xml'
-        if not io.os.path.exists(path):
-            print('Running dsexport for URL metadata', file=sys.stderr, end='\n')
-            dsexport('URL', metadata=True, props=['noprops'])
-        print('Processing URL metadata', file=sys.stderr, end='\n')
-        with io.open(path, 'r', encoding='utf-8') as f:
-            input_xml = escape_illegal_xml_characters(f.read())
-        documents.update(get_documents(input_xml))
-        del input_xml
+    with ProcessPoolExecutor(max_workers=3) as executor:
+        futures = []
+        if args.input_xml:
+            for path in args.input_xml:
+                futures.append(executor.submit(get_documents_from_path, path, details=True))
+        else:
+            path = DOCUHIDE_PATH+'Collection/Collection.xml'
+            if not os.path.exists(path):
+                print('Running dsexport for Collection metadata', file=sys.stderr, end='\n')
+                dsexport(['Collection'], metadata=True, props=['title', 'create_date', 'sort_order'])
+            print('Processing Collection metadata', file=sys.stderr, end='\n')
+            futures.append(executor.submit(get_documents_cached, path))
+
+            path = DOCUHIDE_PATH+'Document/Document.xml'
+            if not os.path.exists(path):
+                print('Running dsexport for Document metadata', file=sys.stderr, end='\n')
+                dsexport(['Document'], metadata=True, props=['noprops'])
+            print('Processing Document metadata', file=sys.stderr, end='\n')
+            futures.append(executor.submit(get_documents_cached, path))
+
+            path = DOCUHIDE_PATH+'URL/URL.xml'
+            if not os.path.exists(path):
+                print('Running dsexport for URL metadata', file=sys.stderr, end='\n')
+                dsexport(['URL'], metadata=True, props=['noprops'])
+            print('Processing URL metadata', file=sys.stderr, end='\n')
+            futures.append(executor.submit(get_documents_cached, path))
+
+        for future in futures:
+            documents.update(future.result())
 
     print('Completed processing metadata. Building tree', file=sys.stderr, end='\n')
 
@@ -491,55 +698,87 @@ def main():
     # print tree
     print('Outputting tree and documents', file=sys.stderr, end='\n')
 
-    def parallel(iter_, n=args.parallel):
-        batch = tuple(islice(iter_, n))
-        while batch:
-            doc_ids = []
-            for id_, parents in batch:
-                try:
-                    doc = documents[id_]
-                except KeyError:
-                    doc = {'type': 'Document', 'title': '', 'owner': 'root', 'private': False}
-
-                if doc['type'] in IGNORE_DOC_TYPES:
-                    continue
-                if doc['type'] != 'Collection' and args.output:
-                    doc_ids.append(id_)
-
-            if doc_ids:
-                # we need to get the actual document
-                id_ = doc_ids[0]
-                path = os.path.join(DOCUHIDE_PATH, id_)
-                dsexport(' '.join(doc_ids), recursive=True)
-                with io.open(os.path.join(path, id_+'.xml'), 'r', encoding='utf-8') as f:
-                    input_xml = escape_illegal_xml_characters(f.read())
-                new_docs = get_documents(input_xml, details=True)
-                del input_xml
-
-            try:
-                for id_, parents in batch:
+    def export(doc_ids):
+        # we need to get the actual documents
+        id_ = doc_ids[0]
+        # a document in several collections can start more than one pending
+        # batch, so each batch exports into its own directory
+        export_dir = tempfile.mkdtemp(dir=DOCUHIDE_PATH)
+        try:
+            dsexport(doc_ids, recursive=True, dest=os.path.join(export_dir, ''))
+            path = os.path.join(export_dir, id_)
+            if all('title' in documents.get(d, ()) for d in doc_ids):
+                # the metadata was parsed with details, so only the files are needed
+                return export_dir, path, documents
+            return export_dir, path, get_documents_from_path(os.path.join(path, id_+'.xml'), details=True)
+        except Exception:
+            shutil.rmtree(export_dir)
+            raise
+
+    def parallel(iter_, n=args.parallel, workers=max(1, args.export_workers)):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            def next_batch():
+                items = tuple(islice(iter_, n))
+                if not items:
+                    return None, None
+                # look up each record once, for both the export and the output
+                batch = []
+                doc_ids = []
+                for id_, parents in items:
                     try:
                         doc = documents[id_]
                     except KeyError:
                         doc = {'type': 'Document', 'title': '', 'owner': 'root', 'private': False}
 
-                    base_path = None
                     if doc['type'] in IGNORE_DOC_TYPES:
                         continue
+                    batch.append((id_, parents, doc))
                     if doc['type'] != 'Collection' and args.output:
-                        doc = new_docs[id_]
-                        base_path = path
+                        doc_ids.append(id_)
+
+                future = executor.submit(export, doc_ids) if doc_ids else None
+                return batch, future
+
+            pending = deque([next_batch()])
+            while True:
+                # keep every worker exporting while the oldest batch is written out
+                while len(pending) <= workers and pending[-1][0] is not None:
+                    pending.append(next_batch())
+                batch, future = pending.popleft()
+                if batch is None:
+                    break
 
-                    yield (id_, parents, doc, base_path)
-            finally:
-                if doc_ids:
-                    # clean up
-                    shutil.rmtree(path)
-            batch = tuple(islice(iter_, n))
+                if future:
+                    export_dir, path, new_docs = future.result()
+
+                try:
+                    for id_, parents, doc in batch:
+                        base_path = None
+                        if doc['type'] != 'Collection' and args.output:
+                            doc = new_docs[id_]
+                            base_path = path
+
+                        yield (id_, parents, doc, base_path)
+                finally:
+                    if future:
+                        # clean up
+                        shutil.rmtree(export_dir)
+
+    load_ldap_uids(doc['username'] for doc in documents.values() if doc['type'] == 'User')
+
+    # resolve each owner to a username and uid once, not per document
+    owner_users = {}
+    for id_, doc in documents.items():
+        if doc['type'] == 'User':
+            owner_users[id_] = (doc['username'], UID_CACHE.get(doc['username'], 0))
+    root_user = ('root', UID_CACHE.get('root', 0))
 
     wt = TreeWalker(tree, skip_level=args.max_depth, traversal_type='bfs')
     tree_iter = wt.traverse(id_=args.sub_collection)
-    with io.open(args.output_mapping, 'w', 1) as mapping_file:
+    # siblings share the same parents tuple, so only build its path once
+    last_parents = None
+    mapped = 0
+    with io.open(args.output_mapping, 'w', buffering=1<<20) as mapping_file:
         for id_, parents, doc, base_path in progress(len(tree.nodes), parallel(tree_iter)):
             level = len(parents)
             if doc['type'] in IGNORE_DOC_TYPES:
@@ -549,21 +788,22 @@ def main():
             title = doc['title']
             private = doc['private']
             owner = doc['owner']
-            user = documents.get(owner,{}).get('username','root')
-            uid = UID_CACHE.get(user, 0)
+            user, uid = owner_users.get(owner, root_user)
             print('|'+'-'*level + id_, user, private)#, title, user, uid, private)
 
             # make posix output
             if args.output:
-                if level == 0:
-                    dir_path = args.output
-                else:
+                if parents is not last_parents:
                     dir_path = os.path.join(args.output, *[sanitize(documents[d]['title']) for d in parents])
+                    last_parents = parents
 
                 if doc['type'] == 'Collection':
                     dest_path = os.path.join(dir_path, sanitize(doc['title']))
-                    if not os.path.exists(dest_path):
+                    try:
                         os.mkdir(dest_path)
+                    except FileExistsError:
+                        # left over from a previous run
+                        pass
                     if private:
                         perms = CHMOD_OWNER_DIR
                     else:
@@ -584,7 +824,7 @@ def main():
                             if ext:
                                 dest_path += ext
                         try:
-                            shutil.copyfile(src_path, dest_path)
+                            copy_document(src_path, dest_path)
                         except Exception:
                             print('doc', doc, file=sys.stderr)
                             print('src_path', src_path, file=sys.stderr)
@@ -600,18 +840,15 @@ def main():
                     else:
                         perms = CHMOD_ALL_FILE
 
-                if doc.get('date', None) is not None:
-                    try:
-                        os.utime(dest_path, (doc['date'], doc['date']))
-                    except Exception:
-                        print('cannot set time on', dest_path, file=sys.stderr)
-
-                # set ownership and perms
-                os.chown(dest_path, uid, uid)
-                os.chmod(dest_path, perms)
+                # set times, ownership and perms
+                set_metadata(dest_path, uid, perms, doc.get('date', None))
 
                 # output mapping
                 mapping_file.write(id_ + ',' + dest_path + '\n')
+                mapped += 1
+                if mapped % 1000 == 0:
+                    # keep the mapping reasonably current in case of a crash
+                    mapping_file.flush()
 
     print('Export complete!', file=sys.stderr, end='\n')
 
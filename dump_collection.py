@@ -1,82 +1,157 @@
 from __future__ import print_function
 
 import argparse
-import xml.etree.ElementTree as ET
+import io
 import re
 import subprocess
 import sys
 
-escape_illegal_xml_characters = lambda x: re.sub(u'[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]', '', x)
+try:
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
+    # the stdlib parser is slower, but works the same here
+    import xml.etree.ElementTree as ET
+    HAVE_LXML = False
 
+ILLEGAL_XML_CHARACTERS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
+escape_illegal_xml_characters = lambda x: ILLEGAL_XML_CHARACTERS.sub('', x)
 
-def get_documents(data):
-    """Prints name, size, filename"""
-    root = ET.fromstring(data)
-    #root = tree.getroot()
 
+class ScrubbedReader(object):
+    """Read a text file as utf-8 bytes, dropping illegal xml characters"""
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        while True:
+            data = self.f.read(size)
+            scrubbed = escape_illegal_xml_characters(data)
+            # an empty result means EOF, so skip chunks that scrub to nothing
+            if scrubbed or not data:
+                return scrubbed.encode('utf-8')
+
+
+def xpath(path):
+    """Compile an XPath union of simple paths, optionally ending in text()"""
+    if HAVE_LXML:
+        # compiled once, evaluated by libxml2
+        return ET.XPath(path, smart_strings=False)
+
+    paths = path.split(' | ')
+    def find(elem):
+        ret = []
+        for p in paths:
+            if p.endswith('/text()'):
+                ret.extend(e.text for e in elem.iterfind(p[:-len('/text()')]) if e.text)
+            else:
+                ret.extend(elem.findall(p))
+        return ret
+    return find
+
+
+XPATH_PROPS = xpath('props/*')
+XPATH_VERSIONS = xpath('versions/dsobject')
+XPATH_PREFERRED_VERSION = xpath('destinationlinks/preferredVersion/text()')
+XPATH_RENDITIONS = xpath('renditions/dsobject')
+XPATH_CONTENT_ELEMENTS = xpath('contentelements/contentelement')
+XPATH_CONTAINMENT = xpath('destinationlinks/containment/text()')
+XPATH_SOURCE_CONTAINMENT = xpath('sourcelinks/containment/text()')
+
+
+def get_props(elem):
+    """Map the names of an element's Docushare props to their text"""
+    return dict((prop.attrib['name'], prop.text) for prop in XPATH_PROPS(elem))
+
+
+def iter_children(source, **kwargs):
+    """Stream the direct children of the XML root, freeing each after use"""
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(source, events=('start', 'end'), **kwargs):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        yield elem
+        elem.clear()
+        if HAVE_LXML:
+            # fast-iter: drop the element and any already processed siblings
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        else:
+            root.remove(elem)
+
+
+def get_documents_from_path(path):
+    """Prints name, size, filename, streaming the XML from disk"""
+    kwargs = {'huge_tree': True} if HAVE_LXML else {}
+    with io.open(path, 'r', encoding='utf-8') as f:
+        # only the illegal characters are dropped, so a truncated export still fails
+        return parse_documents(iter_children(ScrubbedReader(f), **kwargs))
+
+
+class ParseError(Exception):
+    """A dsobject that cannot be converted, reported along with its XML"""
+    def __init__(self, msg, xml):
+        super(ParseError, self).__init__(msg, xml)
+
+    def __str__(self):
+        return '\n'.join(self.args)
+
+
+def parse_documents(children):
+    """Parse Docushare dsobjects into collections and documents"""
     collections = {}
     documents = {}
 
-    for child in root:
+    for child in children:
         if 'classname' not in child.attrib:
             continue
 
         type_ = child.attrib['classname']
             
         if type_ == 'Document':
-            sourcelinks = child.find('sourcelinks')
-            if sourcelinks is not None:
-                parent = sourcelinks.find('containment').text
+            sourcelinks = XPATH_SOURCE_CONTAINMENT(child)
+            if sourcelinks:
+                parent = sourcelinks[0]
             else:
                 parent = None
-            props = child.find('props')
-            if props is None:
-                print(ET.tostring(child))
-                raise Exception('no props')
-            for prop in props:
-                if prop.attrib['name'] == 'title':
-                    title = prop.text
-                    break
-            else:
+            props = get_props(child)
+            if not props:
+                raise ParseError('no props', ET.tostring(child, encoding='unicode'))
+            if 'title' not in props:
                 raise Exception('no title in document')
+            title = props['title']
 
-            versions = child.find('versions')
-            if versions is None:
-                print(ET.tostring(child))
-                raise Exception('no versions')
+            versions = XPATH_VERSIONS(child)
+            if not versions:
+                raise ParseError('no versions', ET.tostring(child, encoding='unicode'))
             elif len(versions) == 1:
-                version_object = versions.findall('dsobject')[0]
+                version_object = versions[0]
             else:
-                for obj in child.findall('./destinationlinks/preferredVersion'):
-                    # we have a preferred version, so use it
-                    handle = obj.text
-                    #print("preferred version handle", handle)
-                    for v in versions.findall('dsobject'):
-                        if v.attrib['handle'] == handle:
-                            version_object = v
-                            break
-                    else:
-                        raise Exception('no matching version')
-                    break
-                else:
-                    print(ET.tostring(child))
-                    raise Exception('no preferredVersion')
+                preferred = XPATH_PREFERRED_VERSION(child)
+                if not preferred:
+                    raise ParseError('no preferredVersion', ET.tostring(child, encoding='unicode'))
+                # we have a preferred version, so use it
+                versions_by_handle = dict((v.attrib['handle'], v) for v in versions)
+                if preferred[0] not in versions_by_handle:
+                    raise Exception('no matching version')
+                version_object = versions_by_handle[preferred[0]]
 
-            renditions = version_object.findall('./renditions/dsobject')
+            renditions = XPATH_RENDITIONS(version_object)
             if len(renditions) == 0:
-                print(ET.tostring(child))
-                raise Exception('no rendition')
+                raise ParseError('no rendition', ET.tostring(child, encoding='unicode'))
             elif len(renditions) > 1:
-                print(ET.tostring(child))
-                raise Exception('too many renditions')
+                raise ParseError('too many renditions', ET.tostring(child, encoding='unicode'))
             for r in renditions:
-                for prop in r.find('props'):
-                    if prop.attrib['name'] == 'size':
-                        size = prop.text
-                        break
-                else:
-                    size = -1
-                for o in r.findall('./contentelements/contentelement'):
+                props = get_props(r)
+                size = props.get('size', -1)
+                for o in XPATH_CONTENT_ELEMENTS(r):
                     filename = o.attrib['filename']
                     break
                 else:
@@ -94,48 +169,38 @@ def get_documents(data):
             }
 
         elif type_ == 'Collection':
-            sourcelinks = child.findall('./sourcelinks/containment')
-            if len(sourcelinks) > 0:
-                parent = sourcelinks[0].text
+            sourcelinks = XPATH_SOURCE_CONTAINMENT(child)
+            if sourcelinks:
+                parent = sourcelinks[0]
             else:
                 parent = None
-            props = child.find('props')
-            if props is None:
+            props = get_props(child)
+            if not props:
                 continue
-            for prop in props:
-                if prop.attrib['name'] == 'title':
-                    title = prop.text
-                    break
-            else:
+            if 'title' not in props:
                 raise Exception('no collection title')
+            title = props['title']
             collections[child.attrib['handle']] = {
                 'parent': parent,
                 'title': title,
-                'children': [e.text for e in child.findall('./destinationlinks/containment')],
+                'children': XPATH_CONTAINMENT(child),
             }
 
         elif type_ == 'URL':
-            sourcelinks = child.find('sourcelinks')
-            if sourcelinks is not None:
-                parent = sourcelinks.find('containment').text
+            sourcelinks = XPATH_SOURCE_CONTAINMENT(child)
+            if sourcelinks:
+                parent = sourcelinks[0]
             else:
                 parent = None
-            props = child.find('props')
-            if props is None:
-                print(ET.tostring(child))
-                raise Exception('no props')
-            for prop in props:
-                if prop.attrib['name'] == 'title':
-                    title = prop.text
-                    break
-            else:
+            props = get_props(child)
+            if not props:
+                raise ParseError('no props', ET.tostring(child, encoding='unicode'))
+            if 'title' not in props:
                 raise Exception('no title in document')
-            for prop in props:
-                if prop.attrib['name'] == 'url':
-                    url = prop.text
-                    break
-            else:
+            title = props['title']
+            if 'url' not in props:
                 raise Exception('no url in document')
+            url = props['url']
 
             documents[child.attrib['handle']] = {
                 'parent': parent,
@@ -150,22 +215,21 @@ def get_documents(data):
 
 def walk_tree(collections, root=None, level=0):
     if not root:
-        for c in collections:
-            collection = collections[c]
+        for c, collection in collections.items():
             if not collection['parent']:
                 root = c
                 break
         else:
             raise Exception('cannot find root collection')
 
-    yield root, level
-    c = collections[root]
-    for d in c['children']:
-        if d.startswith('Collection'):
-            for obj in walk_tree(collections, root=d, level=level+1):
-                yield obj
-        else:
-            yield d, level+1
+    # explicit stack instead of recursion, pushed in reverse to keep the order
+    stack = [(root, level)]
+    while stack:
+        id_, level = stack.pop()
+        yield id_, level
+        if id_.startswith('Collection'):
+            children = collections[id_]['children']
+            stack.extend((d, level+1) for d in reversed(children))
 
 
 def main():
@@ -176,17 +240,14 @@ def main():
     args = parser.parse_args()
 
     if args.input_xml:
-        with open(args.input_xml, 'r') as f:
-            input_xml = escape_illegal_xml_characters(f.read())
+        path = args.input_xml
     elif args.collection_id:
-        subprocess.check_call('./dsexport.sh -d /root/ -r -m '+args.collection_id, cwd='/root/docushare/bin', shell=True)
-        with open('/root/'+args.collection_id+'/'+args.collection_id+'.xml', 'r') as f:
-            input_xml = escape_illegal_xml_characters(f.read())
+        subprocess.check_call(['./dsexport.sh', '-d', '/root/', '-r', '-m', args.collection_id], cwd='/root/docushare/bin')
+        path = '/root/'+args.collection_id+'/'+args.collection_id+'.xml'
     else:
         raise Exception('must specify either --input_xml or --collection_id')
 
-    collections, documents = get_documents(input_xml)
-    del input_xml
+    collections, documents = get_documents_from_path(path)
 
     for id_, level in walk_tree(collections):
         if id_.startswith('Collection'):